@@ -7,6 +7,8 @@ from dotenv import load_dotenv
 import asyncio
 import aiohttp
 import json
+import redis
+from datetime import datetime
 
 app = Flask(__name__)
 load_dotenv()
@@ -22,6 +24,20 @@ spotify_client_id = os.environ.get('SPOTIFY_CLIENT_ID')
 spotify_client_secret = os.environ.get('SPOTIFY_CLIENT_SECRET')
 app_url = os.environ.get('APP_URL')
 functions_url = os.environ.get('FUNCTIONS_URL')
+redis_url = os.environ.get('REDIS_URL')
+# per-user sync state, without REDIS_URL every /get-recent call fetches and processes its whole window
+store = redis.Redis.from_url(redis_url, decode_responses=True) if redis_url else None
+max_recent_pages = 20
+# bound the stored history per user, the oldest plays are dropped past RECENT_HISTORY_SIZE tracks
+# and the whole sync state expires after RECENT_HISTORY_TTL seconds without a sync
+recent_history_size = int(os.environ.get('RECENT_HISTORY_SIZE', 1000))
+recent_history_ttl = int(os.environ.get('RECENT_HISTORY_TTL', 30 * 24 * 3600))
+# a play whose processing keeps failing (e.g. a dead preview url) holds the cursor back for this many syncs, then it is skipped
+recent_max_attempts = int(os.environ.get('RECENT_MAX_ATTEMPTS', 3))
+# fan-out to the functions app, throttled responses (429/503) are retried after their Retry-After
+functions_max_concurrency = int(os.environ.get('FUNCTIONS_MAX_CONCURRENCY', 8))
+functions_max_retries = int(os.environ.get('FUNCTIONS_MAX_RETRIES', 5))
+max_retry_after = 30
 
 
 @app.route('/check-token')
@@ -81,6 +97,159 @@ def get_user():
     return jsonify(user)
 
 
+def played_at_ms(item):
+    # spotify timestamps look like 2024-04-01T12:34:56.789Z
+    return int(datetime.fromisoformat(item['played_at'].replace('Z', '+00:00')).timestamp() * 1000)
+
+
+def fetch_recently_played(sp, after, limit=None):
+    # plays strictly after the cursor, paging past spotify's 50 items per request limit unless a limit is given
+    # spotify may hand back plays at or before the cursor, those are dropped and paging stops at the first one
+    page = sp.current_user_recently_played(limit=limit or 50, after=after)
+    items = []
+    pages = 0
+    while page is not None:
+        pages += 1
+        newer = [item for item in page['items'] if played_at_ms(item) > after]
+        items.extend(newer)
+        crossed = len(newer) < len(page['items'])
+        if limit is not None or crossed or not page.get('next') or pages >= max_recent_pages:
+            break
+        page = sp.next(page)
+    return items
+
+
+def sync_keys(user_id):
+    # cursor: newest processed played_at, since: window start the history is complete from,
+    # tracks: track_id -> track json, played: track_id scored by its newest played_at,
+    # failures: track_id -> failed attempts of a play still holding the cursor back
+    return (f'recent:{user_id}:cursor', f'recent:{user_id}:since',
+            f'recent:{user_id}:tracks', f'recent:{user_id}:played', f'recent:{user_id}:failures')
+
+
+def trim_history(db, tracks_key, played_key, since_key, since):
+    # drop the oldest tracks past recent_history_size, the history is then only complete
+    # after the newest dropped play, so since moves up to it
+    overflow = db.zrange(played_key, 0, -(recent_history_size + 1), withscores=True)
+    if not overflow:
+        return
+    track_ids = [track_id for track_id, _ in overflow]
+    pipe = db.pipeline()
+    pipe.hdel(tracks_key, *track_ids)
+    pipe.zrem(played_key, *track_ids)
+    pipe.set(since_key, max(since, int(max(score for _, score in overflow))))
+    pipe.execute()
+
+
+def sync_recent(sp, after, limit, db):
+    # plays within the window (played_at > after), newest first, with new tracks sent to process_mp3
+    # db is the redis client keeping the per-user sync state, None for a full sync of the window
+    # the sync cursor is the played_at (ms) of the newest play already processed for this user,
+    # only plays after it are fetched and sent to process_mp3, older ones come from the stored history
+    history = {}  # stored tracks among the fetched plays
+    if db is not None:
+        user_id = sp.current_user()['id']
+        cursor_key, since_key, tracks_key, played_key, failures_key = sync_keys(user_id)
+        cursor, since = db.mget(cursor_key, since_key)
+        if cursor is not None and since is not None and int(since) <= after:
+            fetch_after = max(int(cursor), after)
+        else:
+            # first sync, or the window now starts before anything we synced
+            fetch_after = after
+    else:
+        fetch_after = after
+    # without the sync state every call is a full sync, so keep it to the requested number of plays
+    recently_played = fetch_recently_played(sp, fetch_after, limit if db is None else None)
+
+    plays = {}  # newest play per track
+    print('items length', len(recently_played))
+    for item in recently_played:
+        preview_url = item['track']['preview_url']
+        if preview_url is None:
+            continue
+        track_id = item["track"]["id"]
+        played_at = played_at_ms(item)
+        if track_id in plays:
+            plays[track_id]['played_at'] = max(plays[track_id]['played_at'], played_at)
+            continue
+        plays[track_id] = {
+            'preview_url': preview_url,
+            'track_id': track_id,
+            'track_name': item["track"]["name"],
+            'played_at': played_at
+        }
+    if db is not None and plays:
+        stored = db.hmget(tracks_key, list(plays))
+        history = {track_id: json.loads(track) for track_id, track in zip(plays, stored) if track is not None}
+    # already processed tracks only need their played_at refreshed
+    payloads = [{key: play[key] for key in ('preview_url', 'track_id', 'track_name')}
+                for track_id, play in plays.items() if track_id not in history]
+
+    result = asyncio.run(get_recent_http(payloads))
+    # print(result)
+    temp = []
+    for item in result:
+        try:
+            decoded = item.decode('utf-8')
+            temp.append(json.loads(decoded))
+        except Exception as e:
+            print(e)
+    processed_ids = set(d['track_id'].lower() for d in temp)
+    failed = set(track_id for track_id in plays
+                 if track_id not in history and track_id.lower() not in processed_ids)
+    for play in plays.values():
+        if play['track_id'] in failed:
+            continue
+        if play['track_id'] in history:
+            play['played_at'] = max(play['played_at'], history[play['track_id']]['played_at'])
+        history[play['track_id']] = play
+
+    updated = [track_id for track_id in plays if track_id not in failed]
+    if db is not None:
+        # failed plays are retried on the next syncs, until they failed recent_max_attempts times
+        retrying = set()
+        if failed:
+            pipe = db.pipeline()
+            for track_id in sorted(failed):
+                pipe.hincrby(failures_key, track_id, 1)
+            attempts = dict(zip(sorted(failed), pipe.execute()))
+            retrying = set(track_id for track_id in failed if attempts[track_id] < recent_max_attempts)
+        pipe = db.pipeline()
+        # the count starts over once a play was processed or given up on, a later play of it gets new attempts
+        settled = updated + sorted(failed - retrying)
+        if settled:
+            pipe.hdel(failures_key, *settled)
+        if plays:
+            # stop the cursor before the first retried play so it is fetched and retried next time
+            if retrying:
+                new_cursor = min(plays[track_id]['played_at'] for track_id in retrying) - 1
+            else:
+                new_cursor = max(play['played_at'] for play in plays.values())
+            if cursor is None or new_cursor > int(cursor):
+                pipe.set(cursor_key, new_cursor)
+        new_since = after if since is None else min(after, int(since))
+        pipe.set(since_key, new_since)
+        if updated:
+            pipe.hset(tracks_key, mapping={track_id: json.dumps(history[track_id]) for track_id in updated})
+            pipe.zadd(played_key, {track_id: history[track_id]['played_at'] for track_id in updated})
+        for key in (cursor_key, since_key, tracks_key, played_key, failures_key):
+            pipe.expire(key, recent_history_ttl)
+        pipe.execute()
+        trim_history(db, tracks_key, played_key, since_key, new_since)
+
+        # newest plays within the window first
+        window = db.zrevrangebyscore(played_key, '+inf', f'({after}', start=0, num=limit)
+        resp = [json.loads(track) for track in db.hmget(tracks_key, window) if track is not None] if window else []
+    else:
+        resp = sorted((history[track_id] for track_id in updated),
+                      key=lambda track: track['played_at'], reverse=True)[:limit]
+
+    # make sure to return the non-lowercased track ids to app
+    resp = [{key: track[key] for key in ('preview_url', 'track_id', 'track_name')} for track in resp]
+    print('resp', len(resp))
+    return resp
+
+
 @app.route('/get-recent', methods=['POST'])
 def get_recent():
     auth_header = request.headers.get('Authorization')
@@ -91,38 +260,15 @@ def get_recent():
 
     sp = spotipy.Spotify(auth=token)
     data = request.get_json()
+    limit = data.get('limit', 20)
+    after = int(data.get('after') or 0)
     try:
-        recently_played = sp.current_user_recently_played(limit=data.get('limit', 20), after=data.get('after'))
-        payloads = []
-        unique_ids = set()  # remove duplicates
-        print('items length', len(recently_played['items']))
-        for item in recently_played['items']:
-            preview_url = item['track']['preview_url']
-            if preview_url is None:
-                continue
-            track_id = item["track"]["id"]
-            if track_id not in unique_ids:
-                unique_ids.add(track_id)
-                payloads.append({
-                    'preview_url': preview_url,
-                    'track_id': track_id,
-                    'track_name': item["track"]["name"]
-                })
-
-        result = asyncio.run(get_recent_http(payloads))
-        # print(result)
-        temp = []
-        for item in result:
-            try:
-                decoded = item.decode('utf-8')
-                temp.append(json.loads(decoded))
-            except Exception as e:
-                print(e)
-        # make sure to return the non-lowercased track ids to app
-        resp = list(
-            filter(lambda track: any(d['track_id'].lower() == track['track_id'].lower() for d in temp), payloads)
-        )
-        print('resp', len(resp))
+        try:
+            resp = sync_recent(sp, after, limit, store)
+        except redis.exceptions.RedisError as e:
+            # without the sync state every call is a full sync, slower but still correct
+            print('redis unavailable, falling back to a full sync: {}'.format(e))
+            resp = sync_recent(sp, after, limit, None)
         return jsonify(resp)
     except spotipy.SpotifyException as e:
         return jsonify({"error": str(e)}), 400
@@ -168,21 +314,38 @@ client_config = dict(trust_env=True, timeout=timeout_config)
 
 
 async def get_recent_http(payloads):
+    semaphore = asyncio.Semaphore(functions_max_concurrency)
     async with aiohttp.ClientSession(**client_config) as sess:
         return await asyncio.gather(
-            *(do_post_parallel(f'{functions_url}/process_mp3', sess, payload) for payload in payloads))
+            *(do_post_parallel(f'{functions_url}/process_mp3', sess, payload, semaphore) for payload in payloads))
 
 
 async def make_predictions(payloads):
+    semaphore = asyncio.Semaphore(functions_max_concurrency)
     async with aiohttp.ClientSession(**client_config) as sess:
         return await asyncio.gather(
-            *(do_post_parallel(f'{functions_url}/predict', sess, payload) for payload in payloads))
+            *(do_post_parallel(f'{functions_url}/predict', sess, payload, semaphore) for payload in payloads))
+
+
+def retry_after_seconds(response, attempt):
+    try:
+        return min(float(response.headers.get('Retry-After')), max_retry_after)
+    except (TypeError, ValueError):
+        # no usable header, back off exponentially
+        return min(2 ** attempt, max_retry_after)
 
 
-async def do_post_parallel(url, sess: ClientSession, payload):
+async def do_post_parallel(url, sess: ClientSession, payload, semaphore: asyncio.Semaphore):
     try:
-        async with sess.post(url=url, json=payload) as response:
-            return await response.read()
+        for attempt in range(functions_max_retries + 1):
+            # release the slot while backing off so other payloads can go
+            async with semaphore:
+                async with sess.post(url=url, json=payload) as response:
+                    if response.status not in (429, 503) or attempt == functions_max_retries:
+                        return await response.read()
+                    delay = retry_after_seconds(response, attempt)
+            print("{} throttled, retrying in {}s".format(url, delay))
+            await asyncio.sleep(delay)
     except Exception as e:
         print("Unable to get url {} due to {}.".format(url, e.__class__))
 
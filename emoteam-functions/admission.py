@@ -0,0 +1,162 @@
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+import workers
+
+# sync functions run on the python worker's thread pool, and both running and queued requests hold one of its
+# threads while they wait here, so the limits have to fit in it or requests queue in the host where priority never applies
+#  PYTHON_THREADPOOL_THREAD_COUNT: the worker's thread pool size, python 3.11 defaults to min(32, cpus + 4)
+#  ADMISSION_HEADROOM: threads left for the routes that are not admitted (warmup, stats, nearest)
+#  ADMISSION_CAPACITY: requests allowed to run at once across all routes, defaults to half of the remaining threads
+#   but at least one more than the preprocessing workers, so every worker can be kept busy next to a prediction
+#  ADMISSION_MAX_QUEUE: requests allowed to wait across all routes, defaults to the rest of the threads
+#  {ROUTE}_MAX_RUNNING / {ROUTE}_MAX_QUEUE: per-route concurrency and number of requests allowed to wait
+#  ADMISSION_TIMEOUT: seconds a queued request waits for a slot before it is rejected
+thread_count = int(os.environ.get('PYTHON_THREADPOOL_THREAD_COUNT') or min(32, (os.cpu_count() or 1) + 4))
+headroom = int(os.environ.get('ADMISSION_HEADROOM', 2))
+thread_budget = max(thread_count - headroom, 2)
+# the stages of one track run one after another, so each running process_mp3 keeps at most one worker busy
+preprocess_running = max(workers.pool_size, 1)
+capacity = int(os.environ.get('ADMISSION_CAPACITY', min(max(thread_budget // 2, preprocess_running + 1), max(thread_budget - 1, 1))))
+max_queue = int(os.environ.get('ADMISSION_MAX_QUEUE', max(thread_budget - capacity, 0)))
+timeout = float(os.environ.get('ADMISSION_TIMEOUT', 10))
+
+class AdmissionRejected(Exception):
+  def __init__(self, route: str, reason: str, retry_after: int):
+    super().__init__('%s rejected: %s' % (route, reason))
+    self.retry_after = retry_after
+
+class RouteLimit:
+  # lower priority values are admitted first
+  def __init__(self, priority: int, max_running: int, max_queued: int):
+    self.priority = priority
+    self.max_running = max_running
+    self.max_queued = max_queued
+
+class AdmissionController:
+  def __init__(self, capacity: int, max_queue: int, limits: dict[str, RouteLimit], timeout: float):
+    self.capacity = capacity
+    self.max_queue = max_queue
+    self.limits = limits
+    self.timeout = timeout
+    self._condition = threading.Condition()
+    self._running = {route: 0 for route in limits}
+    self._waiting: list[tuple[int, int, str]] = [] # (priority, arrival, route)
+    self._evicted: set[tuple[int, int, str]] = set()
+    self._arrivals = itertools.count()
+    self._admitted = {route: 0 for route in limits}
+    self._rejected = {route: 0 for route in limits}
+    # moving average of how long an admitted request runs, used for the Retry-After hint
+    self._service_seconds = {route: 1.0 for route in limits}
+
+  def _can_run(self, route: str) -> bool:
+    return sum(self._running.values()) < self.capacity and self._running[route] < self.limits[route].max_running
+
+  def _is_next(self, ticket: tuple[int, int, str]) -> bool:
+    # a waiter goes once it can run and no earlier or higher priority waiter that could run is ahead of it
+    for other in self._waiting:
+      if other < ticket and self._can_run(other[2]):
+        return False
+    return self._can_run(ticket[2])
+
+  def _queued(self, route: str) -> int:
+    return sum(1 for _, _, other in self._waiting if other == route)
+
+  def _retry_after(self, route: str) -> int:
+    # caller holds the lock
+    # roughly when a slot frees up for this route: the requests ahead of it, served max_running at a time
+    rounds = (self._queued(route) + 1) / max(self.limits[route].max_running, 1)
+    return max(1, math.ceil(rounds * self._service_seconds[route]))
+
+  def retry_after(self, route: str) -> int:
+    # Retry-After hint in seconds for a rejected or throttled request on route
+    with self._condition:
+      return self._retry_after(route)
+
+  def _reject(self, route: str, reason: str):
+    # caller holds the lock
+    self._rejected[route] += 1
+    raise AdmissionRejected(route, reason, self._retry_after(route))
+
+  def _make_room(self, ticket: tuple[int, int, str]) -> bool:
+    # caller holds the lock, the shared queue is full: evict the newest waiter of lower priority, if any
+    lower = [other for other in self._waiting if other[0] > ticket[0] and other not in self._evicted]
+    if not lower:
+      return False
+    self._evicted.add(max(lower))
+    self._condition.notify_all()
+    return True
+
+  @contextmanager
+  def admit(self, route: str):
+    limit = self.limits[route]
+    with self._condition:
+      ticket = (limit.priority, next(self._arrivals), route)
+      if not self._is_next(ticket):
+        if self._queued(route) >= limit.max_queued:
+          self._reject(route, 'queue full')
+        if len(self._waiting) - len(self._evicted) >= self.max_queue and not self._make_room(ticket):
+          self._reject(route, 'queue full')
+        self._waiting.append(ticket)
+        deadline = time.monotonic() + self.timeout
+        try:
+          while not self._is_next(ticket):
+            if ticket in self._evicted:
+              self._reject(route, 'evicted by a higher priority request')
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+              self._reject(route, 'timed out waiting for a slot')
+            self._condition.wait(remaining)
+        finally:
+          self._waiting.remove(ticket)
+          self._evicted.discard(ticket)
+          # the head of the queue may have changed, e.g. when this waiter gave up
+          self._condition.notify_all()
+      self._running[route] += 1
+      self._admitted[route] += 1
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      with self._condition:
+        self._running[route] -= 1
+        self._service_seconds[route] = 0.8 * self._service_seconds[route] + 0.2 * (time.monotonic() - start)
+        self._condition.notify_all()
+
+  def stats(self) -> dict:
+    with self._condition:
+      return {
+        'capacity': self.capacity,
+        'max_queue': self.max_queue,
+        'threads': thread_count,
+        'routes': {route: {
+          'running': self._running[route],
+          'queued': self._queued(route),
+          'admitted': self._admitted[route],
+          'rejected': self._rejected[route],
+          'retry_after': self._retry_after(route)
+        } for route in self.limits}
+      }
+
+def route_limit(route: str, priority: int, max_running: int, max_queued: int) -> RouteLimit:
+  name = route.upper()
+  return RouteLimit(
+    priority,
+    int(os.environ.get(f'{name}_MAX_RUNNING', max_running)),
+    int(os.environ.get(f'{name}_MAX_QUEUE', max_queued))
+  )
+
+if capacity + max_queue > thread_budget:
+  logging.warning('admission limits (capacity %d + queue %d) exceed the %d worker threads available, '
+                  'requests will queue in the host instead' % (capacity, max_queue, thread_budget))
+
+# inference is cheap and user facing, so it goes first, may take over queue spots from preprocessing,
+# and preprocessing leaves at least one slot to it unless there is only one
+controller = AdmissionController(capacity, max_queue, {
+  'predict': route_limit('predict', 0, capacity, max_queue),
+  'process_mp3': route_limit('process_mp3', 1, min(preprocess_running, max(capacity - 1, 1)), max_queue)
+}, timeout)
@@ -0,0 +1,157 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from azure.storage.blob import BlobServiceClient
+from pipeline import preprocess_track
+from inference import input_prefixes, download_container, load_inputs, run_model, save_prediction, model_version
+from workers import pool
+from emotion_index import update_snapshot
+
+# Re-runs preprocessing and/or prediction for a list of tracks straight against blob storage,
+# without going through the HTTP functions. Progress is appended to a checkpoint file after every
+# track, so re-running the same command after a crash continues where it stopped.
+#
+# usage: STORAGE_CONNECTION_STRING=... python backfill.py tracks.csv --model-version best_model
+# tracks.csv needs a header with at least track_id and preview_url columns
+
+def read_tracks(path: str) -> list[dict]:
+  with open(path, newline='') as f:
+    # keep the original spotify id for predictions, containers and the checkpoint use the lower-cased one
+    return [row for row in csv.DictReader(f) if row.get('track_id')]
+
+def job_key(args) -> str:
+  # what a run does, a track finished by one job (e.g. predictions for best_model) is not done for another
+  mode = 'preprocess' if args.skip_predict else 'predict' if args.skip_preprocess else 'preprocess+predict'
+  if args.overwrite and not args.skip_preprocess:
+    mode += '+overwrite'
+  return '%s:%s' % (args.model_version, mode)
+
+def read_checkpoint(path: str, job: str) -> dict[str, dict]:
+  # last entry per track of this job wins, a track is only skipped once it has finished successfully
+  done = {}
+  if not os.path.exists(path):
+    return done
+  with open(path) as f:
+    for line in f:
+      line = line.strip()
+      if not line:
+        continue
+      try:
+        entry = json.loads(line)
+      except json.JSONDecodeError:
+        # a crash can leave a partially written last line
+        continue
+      if entry.get('job') != job:
+        continue
+      done[entry['track_id']] = entry
+  return {track_id: entry for track_id, entry in done.items() if entry.get('status') == 'done'}
+
+class Checkpoint:
+  def __init__(self, path: str):
+    self._lock = threading.Lock()
+    self._file = open(path, 'a')
+
+  def record(self, entry: dict):
+    with self._lock:
+      self._file.write(json.dumps(entry) + '\n')
+      self._file.flush()
+      os.fsync(self._file.fileno())
+
+  def close(self):
+    self._file.close()
+
+def download_eda(blob_service_client: BlobServiceClient, eda_dir: str) -> dict[str, str]:
+  # the sample EDAs are the same for every track, download them once per run
+  eda_container = blob_service_client.get_container_client(container='eda-data')
+  if not eda_container.exists():
+    raise RuntimeError('eda container does not exist')
+  return download_container(eda_container, eda_dir)
+
+def predict_track(blob_service_client: BlobServiceClient, track_id: str, eda_files: dict[str, str], version: str):
+  song_container = blob_service_client.get_container_client(container=f'spotify-{track_id.lower()}')
+  scratch_dir = tempfile.mkdtemp(prefix=f'{track_id.lower()}-')
+  try:
+    temp_files = download_container(song_container, scratch_dir, input_prefixes)
+    temp_files.update(eda_files)
+    spectrogram, eda_tensor, music_vector = load_inputs(temp_files)
+    if spectrogram is None or music_vector is None or eda_tensor is None:
+      raise ValueError('missing data, cannot run predictions unless all are present')
+    arousal, valence, embedding = run_model(spectrogram, eda_tensor, music_vector, version)
+    return {'track_id': track_id, 'arousal': arousal, 'valence': valence}, embedding
+  finally:
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def process_track(blob_service_client: BlobServiceClient, track: dict, args, eda_files: dict[str, str]) -> dict:
+  track_id = track['track_id'].lower()
+  entry = {'track_id': track_id, 'model_version': args.model_version, 'job': job_key(args)}
+  try:
+    if not args.skip_preprocess:
+      upload_status = preprocess_track(blob_service_client, track_id, track['preview_url'], overwrite=args.overwrite)
+      entry['upload_status'] = upload_status
+      # stages log and carry on, so a returned status is not necessarily a complete one
+      missing = [artifact for artifact in ('features', 'spectrogram') if not upload_status[artifact]]
+      if missing:
+        raise ValueError('missing artifacts %s' % ', '.join(missing))
+    if not args.skip_predict:
+      prediction, embedding = predict_track(blob_service_client, track['track_id'], eda_files, args.model_version)
+      save_prediction(blob_service_client, args.model_version, prediction, embedding)
+      entry['prediction'] = prediction
+    entry['status'] = 'done'
+  except Exception as e:
+    logging.warning('backfill failed for track %s: %s' % (track_id, e))
+    entry['status'] = 'failed'
+    entry['error'] = str(e)
+  return entry
+
+def main():
+  parser = argparse.ArgumentParser(description='Bulk preprocessing and prediction backfill')
+  parser.add_argument('tracks', help='csv file with track_id and preview_url columns')
+  parser.add_argument('--checkpoint', help='progress file used to resume, defaults to backfill-{model_version}.jsonl')
+  parser.add_argument('--batch-size', type=int, default=50)
+  parser.add_argument('--parallel', type=int, default=max(pool.size, 1), help='tracks processed concurrently')
+  parser.add_argument('--model-version', default=model_version, help='weights {model_version}.pt are used and predictions are stored under this prefix')
+  parser.add_argument('--overwrite', action='store_true', help='replace existing artifacts, e.g. for a new feature version')
+  parser.add_argument('--skip-preprocess', action='store_true', help='only run predictions on existing artifacts')
+  parser.add_argument('--skip-predict', action='store_true', help='only (re)compute artifacts')
+  parser.add_argument('--skip-index', action='store_true', help='do not update the emotion index snapshot afterwards')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+
+  blob_service_client = BlobServiceClient.from_connection_string(os.environ['STORAGE_CONNECTION_STRING'])
+  tracks = read_tracks(args.tracks)
+  if args.checkpoint is None:
+    args.checkpoint = f'backfill-{args.model_version}.jsonl'
+  done = read_checkpoint(args.checkpoint, job_key(args))
+  pending = [track for track in tracks if track['track_id'].lower() not in done]
+  logging.info('%d tracks, %d already done, %d to process' % (len(tracks), len(tracks) - len(pending), len(pending)))
+
+  eda_dir = tempfile.mkdtemp(prefix='eda-')
+  checkpoint = Checkpoint(args.checkpoint)
+  failed = 0
+  try:
+    eda_files = {} if args.skip_predict else download_eda(blob_service_client, eda_dir)
+    with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+      for start in range(0, len(pending), args.batch_size):
+        batch = pending[start:start + args.batch_size]
+        for entry in executor.map(lambda track: process_track(blob_service_client, track, args, eda_files), batch):
+          checkpoint.record(entry)
+          failed += entry['status'] != 'done'
+        logging.info('processed %d/%d tracks, %d failed' % (min(start + args.batch_size, len(pending)), len(pending), failed))
+  finally:
+    checkpoint.close()
+    shutil.rmtree(eda_dir, ignore_errors=True)
+  logging.info('preprocessing pool stats %s' % json.dumps(pool.stats()))
+  if not args.skip_predict and not args.skip_index:
+    # so /nearest sees the new predictions without waiting for the snapshot timer
+    update_snapshot(blob_service_client, args.model_version)
+  # non-zero exit so a wrapper script knows to re-run, failed tracks are retried on the next run
+  return 1 if failed else 0
+
+if __name__ == "__main__":
+  raise SystemExit(main())
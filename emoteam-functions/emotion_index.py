@@ -0,0 +1,344 @@
+import argparse
+import io
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from scipy.spatial import cKDTree
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient
+from inference import predictions_container, model_version
+
+# tracks added or moved since the kd-tree was built are searched brute-force,
+# the tree is rebuilt (dropping the slots of moved tracks) past this many
+max_pending = 1024
+
+class IndexNotBuiltError(Exception):
+  # raised when there is no snapshot to load, it is written by the backfill, the snapshot timer or the CLI
+  pass
+
+class EmotionIndex:
+  # nearest-neighbour index over predicted tracks
+  # mood points (arousal, valence) are searched with a kd-tree,
+  # fused embeddings (cosine similarity) with a vectorized brute-force scan
+  def __init__(self, track_ids: list[str], points: np.ndarray, embeddings: np.ndarray = None):
+    self._lock = threading.Lock()
+    # spotify ids are case-sensitive, they are returned as given and only looked up case-insensitively
+    # track_ids holds one entry per slot, including the stale slots of tracks that moved to the pending tail
+    self.track_ids = list(track_ids)
+    self._positions = {track_id.lower(): i for i, track_id in enumerate(self.track_ids)}
+    self._stale: set[int] = set()
+    # arrays are over-allocated and grown by doubling so adding a track does not copy the whole catalog
+    self._points = np.asarray(points, dtype=np.float32).reshape(-1, 2).copy()
+    self._embeddings = None if embeddings is None else _normalize(np.asarray(embeddings, dtype=np.float32))
+    self._tree = cKDTree(self.points) if len(self.track_ids) else None
+    self._tree_size = len(self.track_ids)
+
+  def __len__(self):
+    return len(self._positions)
+
+  def __contains__(self, track_id: str) -> bool:
+    return track_id.lower() in self._positions
+
+  @property
+  def points(self) -> np.ndarray:
+    return self._points[:len(self.track_ids)]
+
+  @property
+  def embeddings(self) -> np.ndarray:
+    return None if self._embeddings is None else self._embeddings[:len(self.track_ids)]
+
+  def _reserve(self, size: int):
+    # caller holds the lock
+    if size <= len(self._points):
+      return
+    capacity = max(size, 2 * len(self._points), 16)
+    points = np.zeros((capacity, 2), dtype=np.float32)
+    points[:len(self._points)] = self._points
+    self._points = points
+    if self._embeddings is not None:
+      embeddings = np.zeros((capacity, self._embeddings.shape[1]), dtype=np.float32)
+      embeddings[:len(self._embeddings)] = self._embeddings
+      self._embeddings = embeddings
+
+  def add(self, track_id: str, arousal: float, valence: float, embedding: list[float] = None):
+    key = track_id.lower()
+    with self._lock:
+      if embedding is not None and self._embeddings is None and len(self.track_ids) == 0:
+        self._embeddings = np.zeros((len(self._points), len(embedding)), dtype=np.float32)
+
+      point = np.array([arousal, valence], dtype=np.float32)
+      vector = None
+      if embedding is not None and self._embeddings is not None:
+        vector = _normalize(np.array([embedding], dtype=np.float32))[0]
+
+      i = self._positions.get(key)
+      if i is not None and np.array_equal(self._points[i], point) and (vector is None or np.allclose(self._embeddings[i], vector)):
+        # e.g. the same track predicted again
+        return
+      if i is None or i < self._tree_size:
+        # new tracks, and tracks whose point the tree holds, go to the pending tail,
+        # a moved track's old slot is skipped by queries until the next rebuild drops it
+        previous = i
+        i = len(self.track_ids)
+        self._reserve(i + 1)
+        self._positions[key] = i
+        self.track_ids.append(track_id)
+        if previous is not None:
+          self._stale.add(previous)
+          if vector is None and self._embeddings is not None:
+            self._embeddings[i] = self._embeddings[previous]
+      self._points[i] = point
+      if vector is not None:
+        self._embeddings[i] = vector
+      if len(self.track_ids) - self._tree_size > max_pending:
+        self._tree = None
+
+  def _compact(self):
+    # caller holds the lock, drops the stale slots
+    if not self._stale:
+      return
+    keep = np.array([i for i in range(len(self.track_ids)) if i not in self._stale], dtype=np.int64)
+    self.track_ids = [self.track_ids[i] for i in keep]
+    self._points = self._points[keep]
+    if self._embeddings is not None:
+      self._embeddings = self._embeddings[keep]
+    self._positions = {track_id.lower(): i for i, track_id in enumerate(self.track_ids)}
+    self._stale = set()
+
+  def _get_tree(self):
+    # caller holds the lock
+    if self._tree is None and len(self.track_ids):
+      self._compact()
+      self._tree = cKDTree(self.points)
+      self._tree_size = len(self.points)
+    return self._tree
+
+  def nearest_point(self, arousal: float, valence: float, k: int = 10, exclude: str = None) -> list[dict]:
+    query = np.array([arousal, valence], dtype=np.float32)
+    with self._lock:
+      tree = self._get_tree()
+      if tree is None:
+        return []
+      extra = 1 if exclude is not None else 0
+      # stale slots are all in the tree, ask for enough extra neighbours to skip them
+      distances, indices = tree.query(query, k=min(k + extra + len(self._stale), self._tree_size))
+      distances = np.atleast_1d(distances)
+      indices = np.atleast_1d(indices)
+      # tracks added after the tree was built
+      if len(self.points) > self._tree_size:
+        pending = self.points[self._tree_size:]
+        distances = np.concatenate([distances, np.linalg.norm(pending - query, axis=1)])
+        indices = np.concatenate([indices, np.arange(self._tree_size, len(self.points))])
+      order = np.argsort(distances)
+      return self._results(indices[order], distances[order], 'distance', k, exclude)
+
+  def nearest_embedding(self, embedding, k: int = 10, exclude: str = None) -> list[dict]:
+    with self._lock:
+      if self.embeddings is None or len(self.embeddings) == 0:
+        return []
+      query = _normalize(np.asarray(embedding, dtype=np.float32).reshape(1, -1))[0]
+      similarities = self.embeddings @ query
+      top = min(k + 1 + len(self._stale), len(similarities))
+      indices = np.argpartition(-similarities, top - 1)[:top]
+      indices = indices[np.argsort(-similarities[indices])]
+      return self._results(indices, similarities[indices], 'similarity', k, exclude)
+
+  def nearest_track(self, track_id: str, k: int = 10, use_embedding: bool = False) -> list[dict]:
+    # neighbours of a track that is already in the index, raises KeyError otherwise
+    with self._lock:
+      i = self._positions[track_id.lower()]
+      point = self.points[i].copy()
+      vector = None if self._embeddings is None else self._embeddings[i].copy()
+    if use_embedding:
+      if vector is None:
+        return []
+      return self.nearest_embedding(vector, k, exclude=track_id.lower())
+    return self.nearest_point(float(point[0]), float(point[1]), k, exclude=track_id.lower())
+
+  def _results(self, indices, scores, score_name: str, k: int, exclude: str) -> list[dict]:
+    # caller holds the lock
+    results = []
+    for i, score in zip(indices, scores):
+      if i in self._stale:
+        continue
+      track_id = self.track_ids[i]
+      if exclude is not None and track_id.lower() == exclude.lower():
+        continue
+      results.append({
+        'track_id': track_id,
+        'arousal': float(self.points[i][0]),
+        'valence': float(self.points[i][1]),
+        score_name: float(score)
+      })
+      if len(results) == k:
+        break
+    return results
+
+  def to_bytes(self) -> bytes:
+    with self._lock:
+      buffer = io.BytesIO()
+      live = np.array([i for i in range(len(self.track_ids)) if i not in self._stale], dtype=np.int64)
+      arrays = {'track_ids': np.array([self.track_ids[i] for i in live]), 'points': self.points[live]}
+      if self.embeddings is not None:
+        arrays['embeddings'] = self.embeddings[live]
+      np.savez(buffer, **arrays)
+      return buffer.getvalue()
+
+  @classmethod
+  def from_bytes(cls, data: bytes) -> 'EmotionIndex':
+    arrays = np.load(io.BytesIO(data))
+    embeddings = arrays['embeddings'] if 'embeddings' in arrays.files else None
+    return cls(arrays['track_ids'].tolist(), arrays['points'], embeddings)
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+  norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+  norms[norms == 0] = 1
+  return vectors / norms
+
+def snapshot_name(version: str) -> str:
+  return f'{version}/index.npz'
+
+def build_from_predictions(blob_service_client: BlobServiceClient, version: str, since: datetime = None) -> EmotionIndex:
+  # scans every stored prediction of the model version, or only those written after since,
+  # slow on a big catalog, so it only runs offline (backfill, snapshot timer, CLI) and never on a request
+  container_client = blob_service_client.get_container_client(container=predictions_container)
+  track_ids, points, embeddings = [], [], []
+  for blob in container_client.list_blobs(name_starts_with=f'{version}/'):
+    if not blob.name.endswith('.json') or (since is not None and blob.last_modified < since):
+      continue
+    prediction = json.loads(container_client.get_blob_client(blob=blob.name).download_blob().readall())
+    track_ids.append(prediction['track_id'])
+    points.append([prediction['arousal'], prediction['valence']])
+    embeddings.append(prediction.get('embedding'))
+  has_embeddings = len(embeddings) > 0 and all(embedding is not None for embedding in embeddings)
+  return EmotionIndex(track_ids, np.array(points, dtype=np.float32), np.array(embeddings, dtype=np.float32) if has_embeddings else None)
+
+def load_index(blob_service_client: BlobServiceClient, version: str) -> tuple[EmotionIndex, str]:
+  # loads the snapshot, a single blob, returns the index and the snapshot's etag
+  # raises IndexNotBuiltError when there is no snapshot yet, scanning every prediction takes far too long for a request
+  container_client = blob_service_client.get_container_client(container=predictions_container)
+  try:
+    downloader = container_client.get_blob_client(blob=snapshot_name(version)).download_blob()
+    return EmotionIndex.from_bytes(downloader.readall()), downloader.properties.etag
+  except ResourceNotFoundError:
+    raise IndexNotBuiltError('no emotion index snapshot for %s yet' % version)
+
+def snapshot_etag(blob_service_client: BlobServiceClient, version: str) -> str:
+  container_client = blob_service_client.get_container_client(container=predictions_container)
+  try:
+    return container_client.get_blob_client(blob=snapshot_name(version)).get_blob_properties().etag
+  except ResourceNotFoundError:
+    return None
+
+def fetch_prediction(blob_service_client: BlobServiceClient, version: str, track_id: str) -> dict:
+  # a single stored prediction, None if the track has not been predicted for this version
+  container_client = blob_service_client.get_container_client(container=predictions_container)
+  try:
+    data = container_client.get_blob_client(blob=f'{version}/{track_id.lower()}.json').download_blob().readall()
+  except ResourceNotFoundError:
+    return None
+  return json.loads(data)
+
+def save_snapshot(blob_service_client: BlobServiceClient, version: str, index: EmotionIndex, listed_at: datetime):
+  # listed_at is when the predictions in the index were listed, later updates pick up from there
+  container_client = blob_service_client.get_container_client(container=predictions_container)
+  container_client.upload_blob(name=snapshot_name(version), data=index.to_bytes(), overwrite=True,
+                               metadata={'listed_at': listed_at.isoformat()})
+
+def update_snapshot(blob_service_client: BlobServiceClient, version: str, full: bool = False) -> EmotionIndex:
+  # adds the predictions stored since the snapshot was last written, builds it from every prediction
+  # when there is none yet (or with full), workers pick the new snapshot up by its etag
+  container_client = blob_service_client.get_container_client(container=predictions_container)
+  current, since = None, None
+  if not full:
+    try:
+      downloader = container_client.get_blob_client(blob=snapshot_name(version)).download_blob()
+      current = EmotionIndex.from_bytes(downloader.readall())
+      # a few minutes of overlap in case the storage clock is behind ours, re-adding a prediction is harmless
+      since = datetime.fromisoformat(downloader.properties.metadata['listed_at']) - timedelta(minutes=5)
+    except (ResourceNotFoundError, KeyError):
+      current, since = None, None
+  listed_at = datetime.now(timezone.utc)
+  update = build_from_predictions(blob_service_client, version, since)
+  if current is None:
+    current = update
+  elif len(update) == 0:
+    return current
+  else:
+    embeddings = update.embeddings
+    for i, track_id in enumerate(update.track_ids):
+      point = update.points[i]
+      current.add(track_id, float(point[0]), float(point[1]), None if embeddings is None else embeddings[i].tolist())
+  save_snapshot(blob_service_client, version, current, listed_at)
+  logging.info('saved emotion index for %s with %d tracks (%d new or updated)' % (version, len(current), len(update)))
+  return current
+
+# INDEX_REFRESH_SECONDS: how often a worker checks whether the snapshot changed (by etag) and reloads it
+refresh_interval = float(os.environ.get('INDEX_REFRESH_SECONDS', 60))
+index: EmotionIndex = None
+index_etag: str = None
+index_checked_at = 0.0
+index_lock = threading.Lock()
+# predictions this process added since loading, re-applied to a reloaded snapshot that does not have them yet
+local_predictions: dict[str, tuple] = {}
+
+def get_index(blob_service_client: BlobServiceClient) -> EmotionIndex:
+  # loaded by the nearest route, then reloaded whenever the snapshot changes,
+  # e.g. after the snapshot timer or a backfill picked up predictions from other workers
+  # raises IndexNotBuiltError while there is no snapshot
+  global index, index_etag, index_checked_at
+  if index is not None and time.monotonic() - index_checked_at < refresh_interval:
+    return index
+  with index_lock:
+    if index is not None and time.monotonic() - index_checked_at < refresh_interval:
+      return index
+    if index is None or snapshot_etag(blob_service_client, model_version) not in (None, index_etag):
+      loaded, etag = load_index(blob_service_client, model_version)
+      for key, prediction in list(local_predictions.items()):
+        if key in loaded:
+          del local_predictions[key]
+        else:
+          loaded.add(*prediction)
+      index, index_etag = loaded, etag
+    index_checked_at = time.monotonic()
+  return index
+
+def loaded_index() -> EmotionIndex:
+  # the index if this process already loaded it, None otherwise, never triggers a load
+  return index
+
+def add_prediction(track_id: str, arousal: float, valence: float, embedding: list[float] = None):
+  # add a fresh prediction to the loaded index, if any, and keep it across snapshot reloads
+  current = loaded_index()
+  if current is None:
+    return
+  with index_lock:
+    local_predictions[track_id.lower()] = (track_id, arousal, valence, embedding)
+  current.add(track_id, arousal, valence, embedding)
+
+def find_track(blob_service_client: BlobServiceClient, track_id: str) -> EmotionIndex:
+  # the loaded index, with the track's stored prediction added when it is not in it yet
+  # (predicted by another worker or a backfill since the snapshot was built), raises KeyError if there is none
+  current = get_index(blob_service_client)
+  if track_id not in current:
+    prediction = fetch_prediction(blob_service_client, model_version, track_id)
+    if prediction is None:
+      raise KeyError(track_id)
+    add_prediction(prediction['track_id'], prediction['arousal'], prediction['valence'], prediction.get('embedding'))
+    # the index it was added to, in case a reload swapped it in the meantime
+    current = loaded_index()
+  return current
+
+if __name__ == "__main__":
+  # update the snapshot with predictions stored since it was written, or rebuild it with --full
+  parser = argparse.ArgumentParser(description='Build the emotion index snapshot')
+  parser.add_argument('--model-version', default=model_version)
+  parser.add_argument('--full', action='store_true', help='rebuild from every stored prediction')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+  client = BlobServiceClient.from_connection_string(os.environ['STORAGE_CONNECTION_STRING'])
+  update_snapshot(client, args.model_version, full=args.full)
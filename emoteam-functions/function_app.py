@@ -1,33 +1,70 @@
 import azure.functions as func
+import functools
 import logging
-from model import SpectroEdaMusicNet
-import torch
+import math
 import os
-from azure.storage.blob import BlobServiceClient
-from PIL import Image
 import json
-import numpy as np
-import pandas as pd
-from scipy.interpolate import interp1d
+import shutil
 import tempfile
-import requests
-from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
-from azure.storage.blob import ContainerClient
-from spectrogram import make_spectrogram
-from wav import mp3_to_wav
-from music_features import wav_to_features
-import threading
+import time
+import warmup
+from singleflight import SingleFlight
+from admission import controller, AdmissionRejected
 
+# heavy imports (torch, librosa, pandas, azure sdk...) are deferred to the routes that need them to keep cold starts short
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
-model = SpectroEdaMusicNet()
 storage_connection_string = os.environ['STORAGE_CONNECTION_STRING']
-lock = threading.Lock()
+inflight = SingleFlight()
+
+def admitted(route: str):
+    # per-route concurrency limits and bounded queues, rejected requests get a fast 429 with Retry-After
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(req: func.HttpRequest) -> func.HttpResponse:
+            try:
+                with controller.admit(route):
+                    return fn(req)
+            except AdmissionRejected as e:
+                logging.warning(str(e))
+                return func.HttpResponse(str(e), status_code=429, headers={'Retry-After': str(e.retry_after)})
+        return wrapper
+    return decorator
+
+@app.route(route="warmup", methods=['GET', 'POST'])
+def warmup_route(req: func.HttpRequest) -> func.HttpResponse:
+    # hit this after scale-out so the first real request does not pay for imports, model load and JIT
+    logging.info('warmup function processed a request.')
+    timings = {}
+    try:
+        from workers import pool
+        # with worker processes the host never draws spectrograms, only the workers need the audio stack
+        timings['imports'] = warmup.profile_imports(warmup.HOST_MODULES if pool.size > 0 else warmup.HEAVY_MODULES)
+        start = time.perf_counter()
+        from inference import get_model
+        get_model()
+        timings['model'] = time.perf_counter() - start
+        start = time.perf_counter()
+        if pool.size > 0:
+            # each worker runs warm_audio_stack when it starts
+            pool.warm()
+            timings['workers'] = time.perf_counter() - start
+        else:
+            from pipeline import spectrogram_lock
+            with spectrogram_lock:
+                warmup.warm_audio_stack()
+            timings['audio'] = time.perf_counter() - start
+        return func.HttpResponse(json.dumps(timings), status_code=200)
+    except Exception as e:
+        logging.error('warmup failed %s' % e)
+        return func.HttpResponse("Error: %s" % e, status_code=500)
 
 @app.route(route="process_mp3", methods=['POST'])
 def process_mp3(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('process_mp3 function processed a request.')
+    from azure.storage.blob import BlobServiceClient
+    from pipeline import preprocess_track
+    from workers import PoolBusyError, WorkerCrashedError
 
-    tempfiles = [] # array of tempfile paths
     try:
         req_body = req.get_json()
         if not req_body:
@@ -36,136 +73,126 @@ def process_mp3(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=400
             )
         song = req_body
-        preview_url = song.get('preview_url')
-        track_id = song.get('track_id').lower()
-        if not isinstance(song, dict) or preview_url is None or track_id is None:
+        if not isinstance(song, dict) or song.get('preview_url') is None or song.get('track_id') is None:
             return func.HttpResponse(
                 "Invalid or missing song data found in the payload.",
                 status_code=400
             )
-
-        # Download MP3 file from preview URL
-        # Make the GET request to fetch the MP3 data
-        response = requests.get(preview_url)
-
-        # Check if the request was successful (status code 200)
-        if response.status_code == 200:
-            mp3_data = response.content
-        else:
-            logging.warning("Failed to fetch MP3 data. Status code")
+        preview_url = song.get('preview_url')
+        track_id = song.get('track_id').lower()
 
         # Create Azure BlobServiceClient using connection string
-        try:
-            blob_service_client = BlobServiceClient.from_connection_string(storage_connection_string)
-        except Exception as e:
-            logging.error("Error creating Blob service client:", str(e))
+        blob_service_client = BlobServiceClient.from_connection_string(storage_connection_string)
 
-        # Create container with track ID as name
-        container_name = f'spotify-{track_id}'
-        container_client: ContainerClient = None
-        try:
-            # Create the container with the specified name
-            container_client = blob_service_client.create_container(container_name)
-        except ResourceExistsError:
-            container_client = blob_service_client.get_container_client(container=container_name)
-            logging.info("Container '%s' already exists" % container_name)
-        except Exception as e:
-            logging.error("Error occurred while creating container '%s'" % container_name, e)
+        def run():
+            with controller.admit('process_mp3'):
+                return preprocess_track(blob_service_client, track_id, preview_url)
 
-        # DO PREPROCESSING HERE
-        upload_status = {
-            'track_id': track_id, # LOWER-CASE(D)
-            'mp3': False,
-            'spectrogram': False,
-            'wav': False,
-            'features': False
-        }
-        # 1) upload mp3
-        mp3_file_name = f'song-{track_id}.mp3'
-        try:
-            # Upload the mp3 data as a blob with the specified name
-            container_client.upload_blob(name=mp3_file_name, data=mp3_data)
-            logging.info("Blob '%s' uploaded successfully" % mp3_file_name)
-            upload_status['mp3'] = True
-        except ResourceNotFoundError as e:
-            logging.error("Container does not exist %s" % e)
-        except ResourceExistsError:
-            logging.info("mp3 resource already exists for track %s" % track_id)
-            upload_status['mp3'] = True
-        except Exception as e:
-            logging.warning("Error occurred while uploading mp3 blob: %s" % e)
+        # concurrent requests for the same track share one download and one set of artifacts,
+        # only the first one takes an admission slot, the others wait for its result
+        upload_status = inflight.do(track_id, run)
+        return func.HttpResponse(json.dumps(upload_status), status_code=200)
+    except AdmissionRejected as e:
+        logging.warning(str(e))
+        return func.HttpResponse(str(e), status_code=429, headers={'Retry-After': str(e.retry_after)})
+    except PoolBusyError as e:
+        logging.warning('rejecting process_mp3 request: %s' % e)
+        return func.HttpResponse("Error: %s" % e, status_code=429, headers={'Retry-After': str(controller.retry_after('process_mp3'))})
+    except WorkerCrashedError as e:
+        logging.error('preprocessing worker crashed: %s' % e)
+        return func.HttpResponse("Error: %s" % e, status_code=503, headers={'Retry-After': str(controller.retry_after('process_mp3'))})
+    except Exception as e:
+        return func.HttpResponse("Error: %s" % e, status_code=500)
 
-        # create temp mp3 file
-        mp3_path = os.path.join(tempfile.gettempdir(), mp3_file_name)
-        with open(file=mp3_path, mode="wb") as new_file:
-            new_file.write(mp3_data)
-        tempfiles.append(mp3_path)
+@app.route(route="preprocess_stats", methods=['GET'])
+def preprocess_stats(req: func.HttpRequest) -> func.HttpResponse:
+    # utilization of the preprocessing worker pool
+    from workers import pool
+    return func.HttpResponse(json.dumps(pool.stats()), status_code=200)
 
-        # assume container does not exist is caught above, do not catch anymore
-        # 2) wav
-        try:
-            wav_file_name = f'wav-{track_id}.wav'
-            wav_path = os.path.join(tempfile.gettempdir(), wav_file_name)
-            mp3_to_wav(mp3_path, wav_path)
-            with open(wav_path, 'rb') as wav_file:
-                wav_bytes = wav_file.read()
-            container_client.upload_blob(name=wav_file_name, data=wav_bytes)
-            logging.info("Blob '%s' uploaded successfully" % wav_file_name)
-            upload_status['wav'] = True
-        except ResourceExistsError:
-            logging.info("wav resource already exists for track %s" % track_id)
-            upload_status['wav'] = True
-        except Exception as e:
-            logging.warning('Error occurred while uploading wav blob: %s' % e)
+@app.route(route="admission_stats", methods=['GET'])
+def admission_stats(req: func.HttpRequest) -> func.HttpResponse:
+    # running, queued and rejected requests per admitted route
+    return func.HttpResponse(json.dumps(controller.stats()), status_code=200)
 
-        # 3) music features
-        try:
-            features_file_name = f'features-{track_id}.csv'
-            features_path = os.path.join(tempfile.gettempdir(), features_file_name)
-            wav_to_features(wav_path, features_path, track_id)
-            with open(features_path, 'rb') as features_file:
-                features_bytes = features_file.read()
-            container_client.upload_blob(name=features_file_name, data=features_bytes)
-            logging.info("Blob '%s' uploaded successfully" % features_file_name)
-            upload_status['features'] = True
-        except ResourceExistsError:
-            logging.info("features resource already exists for track %s" % track_id)
-            upload_status['features'] = True
-        except Exception as e:
-            logging.warning('Error occurred while uploading features csv: %s' % e)
-
-        # 4) spectrogram
+@app.route(route="nearest", methods=['POST'])
+def nearest(req: func.HttpRequest) -> func.HttpResponse:
+    # tracks nearest to a mood point {arousal, valence} or to a predicted track {track_id}
+    # set use_embedding to compare tracks by their fused model embedding instead of their mood point
+    logging.info('nearest function processed a request.')
+    from azure.storage.blob import BlobServiceClient
+    from emotion_index import get_index, find_track, IndexNotBuiltError
+    try:
+        req_body = req.get_json()
+    except ValueError:
+        return func.HttpResponse("Request body must be json", status_code=400)
+    if not req_body or not isinstance(req_body, dict):
+        return func.HttpResponse("Request body is required", status_code=400)
+    try:
+        k = int(req_body.get('k', 10))
+    except (TypeError, ValueError):
+        return func.HttpResponse('k must be an integer', status_code=400)
+    if k < 1:
+        return func.HttpResponse('k must be at least 1', status_code=400)
+    use_embedding = req_body.get('use_embedding', False)
+    if isinstance(use_embedding, str) and use_embedding.lower() in ('true', 'false'):
+        use_embedding = use_embedding.lower() == 'true'
+    if not isinstance(use_embedding, bool):
+        return func.HttpResponse('use_embedding must be true or false', status_code=400)
+    track_id = req_body.get('track_id')
+    arousal = req_body.get('arousal')
+    valence = req_body.get('valence')
+    if track_id is None and (arousal is None or valence is None):
+        return func.HttpResponse('Provide either track_id or both arousal and valence', status_code=400)
+    if track_id is not None and not isinstance(track_id, str):
+        return func.HttpResponse('track_id must be a string', status_code=400)
+    if track_id is None:
         try:
-            spectrogram_file_name = f'spectrogram-{track_id}.png'
-            spectrogram_path = os.path.join(tempfile.gettempdir(), spectrogram_file_name)
-            with lock:
-                make_spectrogram(mp3_path, spectrogram_path)
-            with open(spectrogram_path, 'rb') as spectrogram_file:
-                spectrogram_bytes = spectrogram_file.read()
-            container_client.upload_blob(name=spectrogram_file_name, data=spectrogram_bytes)
-            logging.info("Blob '%s' uploaded successfully" % spectrogram_file_name)
-            upload_status['spectrogram'] = True
-        except ResourceExistsError:
-            logging.info("spectrogram resource already exists for track %s" % track_id)
-            upload_status['spectrogram'] = True
-        except Exception as e:
-            logging.warning("Error occurred while uploading spectrogram blob: %s" % e)
-        
+            arousal, valence = float(arousal), float(valence)
+        except (TypeError, ValueError):
+            return func.HttpResponse('arousal and valence must be numbers', status_code=400)
+        if not (math.isfinite(arousal) and math.isfinite(valence)):
+            return func.HttpResponse('arousal and valence must be numbers', status_code=400)
 
-        return func.HttpResponse(json.dumps(upload_status), status_code=200)
+    try:
+        blob_service_client = BlobServiceClient.from_connection_string(storage_connection_string)
+        if track_id is not None:
+            # falls back to the track's stored prediction when the loaded snapshot does not have it yet
+            index = find_track(blob_service_client, track_id)
+        else:
+            index = get_index(blob_service_client)
+    except KeyError:
+        return func.HttpResponse('Track %s has no prediction yet' % track_id, status_code=404)
+    except IndexNotBuiltError as e:
+        logging.warning(str(e))
+        return func.HttpResponse('index not built', status_code=503)
     except Exception as e:
-        return func.HttpResponse("Error: %s" % e, status_code=500)
-    finally:
-        # always clear tempfiles
-        for tempfile_path in tempfiles:
-            if os.path.exists(tempfile_path):
-                os.remove(tempfile_path)
+        logging.error('could not load emotion index %s' % e)
+        return func.HttpResponse('cannot load emotion index', status_code=500)
+
+    if track_id is not None:
+        neighbours = index.nearest_track(track_id, k, use_embedding=use_embedding)
+    else:
+        neighbours = index.nearest_point(arousal, valence, k)
+    return func.HttpResponse(json.dumps(neighbours), status_code=200)
+
+@app.schedule(schedule="0 0 * * * *", arg_name="timer", run_on_startup=False)
+def index_snapshot(timer: func.TimerRequest) -> None:
+    # hourly, adds predictions stored since the last snapshot (builds it the first time) off the request path,
+    # workers reload it by its etag
+    from azure.storage.blob import BlobServiceClient
+    from emotion_index import update_snapshot
+    from inference import model_version
+    blob_service_client = BlobServiceClient.from_connection_string(storage_connection_string)
+    update_snapshot(blob_service_client, model_version)
 
- 
 @app.route(route="predict", methods=['POST'])
+@admitted('predict')
 def predict(req: func.HttpRequest) -> func.HttpResponse:
     # scoped to a single song id, and for a single spotify user
     logging.info('predict function processed a request.')
+    from azure.storage.blob import BlobServiceClient
+    from inference import input_prefixes, download_container, load_inputs, run_model, save_prediction, model_version, weights_path
     req_body = req.get_json()
     if not req_body:
         return func.HttpResponse("Request body is required", status_code=400)
@@ -184,6 +211,13 @@ def predict(req: func.HttpRequest) -> func.HttpResponse:
             'Missing spotify user id param',
             status_code=400
         )
+
+    # optional, lets A/B tests run another model version side by side with the default one
+    version = req_body.get('model_version', model_version)
+    try:
+        weights_path(version)
+    except ValueError as e:
+        return func.HttpResponse(str(e), status_code=400)
     
     try:
         blob_service_client = BlobServiceClient.from_connection_string(storage_connection_string)
@@ -205,112 +239,50 @@ def predict(req: func.HttpRequest) -> func.HttpResponse:
             status_code=400
         )
 
-    # list blobs in the container
-    blobs = song_container.list_blobs()
-    temp_files: dict[str, str] = {}
-    for blob in blobs:
-        logging.info('container %s and blob %s' % (container_name, blob.name))
-        # blob.name is the full file name including the file extension
-        name = blob.name.lower()
-        # TODO: uncomment this part until we support user-level eda
-        # if name.startswith('arousal') or name.startswith('valence'):
-        #     # only download the user's EDA
-        #     # expected format: {valence/arousal}-{song id}-{user id}.txt
-        #     # example: valence-1-abcdefg.txt
-        #     blob_user_id = name.split('.')[0].split('-')[-1]
-        #     if blob_user_id != user_id:
-        #         logging.info('found EDA not belonging to user ID, skipping...')
-        #         continue
-
-        blob_client = song_container.get_blob_client(blob=blob.name)
-        path = os.path.join(tempfile.gettempdir(), name)
-        with open(file=path, mode="wb") as new_file:
-            stream = blob_client.download_blob()
-            new_file.write(stream.readall())
-        temp_files[name] = path
-
-    # get sample EDAs
-    eda_container = blob_service_client.get_container_client(container='eda-data')
-    if not eda_container.exists:
-        return func.HttpResponse('eda container does not exist', status_code=500)
-    blobs = eda_container.list_blobs()
-    for blob in blobs:
-        logging.info('getting eda with blob %s' % blob.name)
-        # blob.name is the full file name including the file extension
-        name = blob.name.lower()
-        blob_client = eda_container.get_blob_client(blob=blob.name)
-        path = os.path.join(tempfile.gettempdir(), name)
-        with open(file=path, mode="wb") as new_file:
-            stream = blob_client.download_blob()
-            new_file.write(stream.readall())
-        temp_files[name] = path
-
+    # per-request scratch dir, concurrent predictions for the same track must not share files
+    scratch_dir = tempfile.mkdtemp(prefix=f'{track_id}-')
+    try:
+        # list blobs in the container and download them
+        # TODO: only download the user's EDA once we support user-level eda
+        #  expected format: {valence/arousal}-{song id}-{user id}.txt, example: valence-1-abcdefg.txt
+        temp_files = download_container(song_container, scratch_dir, input_prefixes)
 
-    # load respective data
-    eda_tensor: torch.Tensor = None
-    for name, path in temp_files.items():
-        if name.startswith('spectrogram'):
-            # spectrogram
-            spectrogram = Image.open(path)
-            spectrogram = spectrogram.convert("L")  # Convert to grayscale
-            spectrogram = np.array(spectrogram)
-            spectrogram = torch.tensor(spectrogram, dtype=torch.float32).unsqueeze(0)
-        elif name.startswith('features'):
-            # opensmile features
-            music_df = pd.read_csv(path)
-            music_features = music_df.iloc[0]
-            music_vector = torch.tensor(np.array(music_features), dtype=torch.float32)
-        elif name.startswith('arousal'):
-            # blob is arousal.txt in azure storage, default to arousal which is in line with our training methods
-            with open(path, "r") as f:
-                eda_signal = np.array(json.loads(f.read()))
-            if len(eda_signal) != 896:
-                x = np.arange(len(eda_signal))
-                f = interp1d(x, eda_signal, kind='linear')
-                x_new = np.linspace(0, len(eda_signal) - 1, 896)
-                interpolated_signal = f(x_new)
-            else:
-                interpolated_signal = eda_signal
+        # get sample EDAs
+        eda_container = blob_service_client.get_container_client(container='eda-data')
+        if not eda_container.exists:
+            return func.HttpResponse('eda container does not exist', status_code=500)
+        temp_files.update(download_container(eda_container, scratch_dir))
 
-            eda_tensor = torch.tensor(interpolated_signal, dtype=torch.float32)
+        # load respective data
+        spectrogram, eda_tensor, music_vector = load_inputs(temp_files)
 
-    # make sure required data are not null
-    if spectrogram is None or music_vector is None or eda_tensor is None:
-        return func.HttpResponse('missing data, cannot run predictions unless all are present', status_code=400)
+        # make sure required data are not null
+        if spectrogram is None or music_vector is None or eda_tensor is None:
+            return func.HttpResponse('missing data, cannot run predictions unless all are present', status_code=400)
 
-    spectrogram = spectrogram.unsqueeze(0) # add batch dimension
-    eda_tensor = eda_tensor.unsqueeze(0).unsqueeze(0) # add batch dimension and 2nd dimension "1", becomes 1,1,896
-    #TODO: does LSTM make sense for STATIC features?
-    music_vector = music_vector.unsqueeze(0) # add batch dimension
-    # logging data shapes
-    spectrogram_shape = str(spectrogram.size())
-    music_vector_shape = str(music_vector.size())
-    eda_shape = str(eda_tensor.size())
-    logging.info('spectrogram shape: %s' % spectrogram_shape)
-    logging.info('music vector shape: %s' % music_vector_shape)
-    logging.info('eda shape: %s' % eda_shape)
-    
-    # try to load model and do predictions
-    try:
-        device = torch.device('cpu')
-        model.to(device)
-        model.load_state_dict(torch.load('best_model.pt', map_location='cpu'))
-        model.eval()
+        # try to load model and do predictions
+        try:
+            pred_arousal, pred_valence, embedding = run_model(spectrogram, eda_tensor, music_vector, version)
+        except Exception as e:
+            logging.error('ran into problems during prediction %s' % e)
+            return func.HttpResponse('cannot load model', status_code=500)
 
-        # predict
-        pred_arousal, pred_valence = model(spectrogram, eda_tensor, music_vector)
-        pred_arousal = pred_arousal.item()
-        pred_valence = pred_valence.item()
-        return func.HttpResponse(json.dumps({
+        prediction = {
             'track_id': TRACK_ID,
             'arousal': pred_arousal,
             'valence': pred_valence
-        }), status_code=200)
-    except Exception as e:
-        logging.error('ran into problems during prediction %s' % e)
-        return func.HttpResponse('cannot load model', status_code=500)
+        }
+        # keep the prediction for the emotion index, a failure here should not fail the prediction itself
+        try:
+            from emotion_index import add_prediction
+            save_prediction(blob_service_client, version, prediction, embedding)
+            # only added if this worker already loaded the index, loading is left to /nearest
+            # since it can take long and must not hold up inference
+            if version == model_version:
+                add_prediction(TRACK_ID, pred_arousal, pred_valence, embedding)
+        except Exception as e:
+            logging.warning('could not store prediction for track %s: %s' % (track_id, e))
+        return func.HttpResponse(json.dumps(prediction), status_code=200)
     finally:
         # remove temp files no matter what
-        for path in temp_files.values():
-            if os.path.exists(path):
-                os.remove(path)
\ No newline at end of file
+        shutil.rmtree(scratch_dir, ignore_errors=True)
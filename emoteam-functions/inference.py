@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+import threading
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+from scipy.interpolate import interp1d
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.blob import BlobServiceClient, ContainerClient
+from model import SpectroEdaMusicNet
+
+predictions_container = 'predictions'
+model_version = os.environ.get('MODEL_VERSION', 'best_model')
+models: dict[str, SpectroEdaMusicNet] = {}
+model_lock = threading.Lock()
+
+def weights_path(version: str) -> str:
+    # weights for a model version live next to the app as {version}.pt, e.g. best_model.pt
+    path = f'{version}.pt'
+    if os.path.basename(path) != path or not os.path.exists(path):
+        raise ValueError('unknown model version %s' % version)
+    return path
+
+def get_model(version: str = model_version) -> SpectroEdaMusicNet:
+    # build each model version once per process, on first use
+    # the checkpoint is memory-mapped and the parameters are assigned the mapped storage instead of copied,
+    # so read-only weight pages are shared through the page cache by every worker process and model version
+    if version not in models:
+        with model_lock:
+            if version not in models:
+                state_dict = torch.load(weights_path(version), map_location='cpu', mmap=True, weights_only=True)
+                with torch.device('meta'):
+                    # skip allocating randomly initialised weights that would be replaced anyway
+                    net = SpectroEdaMusicNet()
+                net.load_state_dict(state_dict, assign=True)
+                net.eval()
+                models[version] = net
+    return models[version]
+
+# blobs the model reads from a song container, older containers may also hold mp3 and wav blobs
+input_prefixes = ('spectrogram', 'features', 'arousal')
+
+def download_container(container_client: ContainerClient, scratch_dir: str, prefixes: tuple[str, ...] = None) -> dict[str, str]:
+    # download the blobs of the container into scratch_dir, returns lower-cased blob name -> local path
+    # with prefixes, only blobs whose lower-cased name starts with one of them are downloaded
+    temp_files: dict[str, str] = {}
+    for blob in container_client.list_blobs():
+        logging.info('container %s and blob %s' % (container_client.container_name, blob.name))
+        # blob.name is the full file name including the file extension
+        name = blob.name.lower()
+        if prefixes is not None and not name.startswith(prefixes):
+            continue
+        blob_client = container_client.get_blob_client(blob=blob.name)
+        path = os.path.join(scratch_dir, name)
+        with open(file=path, mode="wb") as new_file:
+            stream = blob_client.download_blob()
+            new_file.write(stream.readall())
+        temp_files[name] = path
+    return temp_files
+
+def load_inputs(temp_files: dict[str, str]):
+    # load spectrogram, eda and music vector from downloaded files, batched and ready for the model
+    # any input that is missing is returned as None
+    spectrogram: torch.Tensor = None
+    eda_tensor: torch.Tensor = None
+    music_vector: torch.Tensor = None
+    for name, path in temp_files.items():
+        if name.startswith('spectrogram'):
+            # spectrogram
+            spectrogram = Image.open(path)
+            spectrogram = spectrogram.convert("L")  # Convert to grayscale
+            spectrogram = np.array(spectrogram)
+            spectrogram = torch.tensor(spectrogram, dtype=torch.float32).unsqueeze(0)
+        elif name.startswith('features'):
+            # opensmile features
+            music_df = pd.read_csv(path)
+            music_features = music_df.iloc[0]
+            music_vector = torch.tensor(np.array(music_features), dtype=torch.float32)
+        elif name.startswith('arousal'):
+            # blob is arousal.txt in azure storage, default to arousal which is in line with our training methods
+            with open(path, "r") as f:
+                eda_signal = np.array(json.loads(f.read()))
+            if len(eda_signal) != 896:
+                x = np.arange(len(eda_signal))
+                f = interp1d(x, eda_signal, kind='linear')
+                x_new = np.linspace(0, len(eda_signal) - 1, 896)
+                interpolated_signal = f(x_new)
+            else:
+                interpolated_signal = eda_signal
+
+            eda_tensor = torch.tensor(interpolated_signal, dtype=torch.float32)
+
+    if spectrogram is not None:
+        spectrogram = spectrogram.unsqueeze(0) # add batch dimension
+        logging.info('spectrogram shape: %s' % str(spectrogram.size()))
+    if eda_tensor is not None:
+        eda_tensor = eda_tensor.unsqueeze(0).unsqueeze(0) # add batch dimension and 2nd dimension "1", becomes 1,1,896
+        logging.info('eda shape: %s' % str(eda_tensor.size()))
+    if music_vector is not None:
+        #TODO: does LSTM make sense for STATIC features?
+        music_vector = music_vector.unsqueeze(0) # add batch dimension
+        logging.info('music vector shape: %s' % str(music_vector.size()))
+    return spectrogram, eda_tensor, music_vector
+
+def run_model(spectrogram: torch.Tensor, eda_tensor: torch.Tensor, music_vector: torch.Tensor, version: str = model_version) -> tuple[float, float, list[float]]:
+    # returns (arousal, valence, fused embedding)
+    net = get_model(version)
+    with torch.no_grad():
+        fused_features = net.embed(spectrogram, eda_tensor, music_vector)
+        pred_arousal = net.arousal_output(fused_features)
+        pred_valence = net.valence_output(fused_features)
+    return pred_arousal.item(), pred_valence.item(), fused_features[0].tolist()
+
+def save_prediction(blob_service_client: BlobServiceClient, model_version: str, prediction: dict, embedding: list[float] = None):
+    # predictions are kept per model version as predictions/{model_version}/{track_id}.json
+    # the fused embedding is stored alongside for the emotion index, it is not part of the API response
+    try:
+        blob_service_client.create_container(predictions_container)
+    except ResourceExistsError:
+        pass
+    container_client = blob_service_client.get_container_client(container=predictions_container)
+    blob_name = f"{model_version}/{prediction['track_id'].lower()}.json"
+    container_client.upload_blob(name=blob_name, data=json.dumps({**prediction, 'embedding': embedding}), overwrite=True)
@@ -52,7 +52,8 @@ class SpectroEdaMusicNet(nn.Module):
         self.arousal_output = nn.Linear(256, 1)
         self.valence_output = nn.Linear(256, 1)
 
-    def forward(self, spectrogram, eda_data, music_vector):
+    def embed(self, spectrogram, eda_data, music_vector):
+        # fused (batch, 256) representation shared by both output heads
         # Initialize an empty tensor to store the fused features
         fused_features = []
 
@@ -81,6 +82,10 @@ class SpectroEdaMusicNet(nn.Module):
         # Fusion of spectrogram and EDA features
         fused_features = torch.cat(tuple(fused_features), dim=1)
         fused_features = self.fusion(fused_features)
+        return fused_features
+
+    def forward(self, spectrogram, eda_data, music_vector):
+        fused_features = self.embed(spectrogram, eda_data, music_vector)
 
         # Output layers
         arousal_output = self.arousal_output(fused_features)
@@ -3,6 +3,7 @@ import pandas as pd
 import numpy as np
 import os
 import subprocess
+from functools import lru_cache
 
 def get_music_features(wav_path, dist_file, opensmile_dir):
   # extract static features of all wavs and load into 1 file
@@ -11,8 +12,20 @@ def get_music_features(wav_path, dist_file, opensmile_dir):
 
   subprocess.check_call([SMILExtract, "-C", config_file, "-I", wav_path, "-O", dist_file, "-instname", wav_path])
 
+@lru_cache(maxsize=None)
+def load_normalization():
+  # read once per process, preprocessing workers reuse these across tracks
+  mean = pd.read_csv('features_mean.csv', header=None, index_col=0).T
+  std = pd.read_csv('features_std.csv', header=None, index_col=0).T
+  mean.reset_index(drop=True, inplace=True)
+  std.reset_index(drop=True, inplace=True)
+  selected_cols = pd.read_csv('./selected_music_features.csv', header=None)
+  selected_cols = np.array(selected_cols).flatten()
+  return mean, std, selected_cols
+
 def wav_to_features(wav_path, output_path, track_id):
-  static_features_file = f"static_features_{track_id}.arff"
+  # keep the arff next to the output so concurrent calls for the same track do not share it
+  static_features_file = os.path.join(os.path.dirname(output_path), f"static_features_{track_id}.arff")
   get_music_features(wav_path, static_features_file, "/usr/local/bin/opensmile")
 
   res = arff.load(open(static_features_file, "r"))
@@ -22,14 +35,9 @@ def wav_to_features(wav_path, output_path, track_id):
   # exclude last col "class", not relevant from opensmile
   df = df.drop(columns=['class', 'name'])
   df.reset_index(drop=True, inplace=True)
-  mean = pd.read_csv('features_mean.csv', header=None, index_col=0).T
-  std = pd.read_csv('features_std.csv', header=None, index_col=0).T
-  mean.reset_index(drop=True, inplace=True)
-  std.reset_index(drop=True, inplace=True)
+  mean, std, selected_cols = load_normalization()
   df = (df - mean) / std # do z-score normalization
   # select relevant cols
-  selected_cols = pd.read_csv('./selected_music_features.csv', header=None)
-  selected_cols = np.array(selected_cols).flatten()
   df = df[selected_cols]
 
   # save to csv
@@ -0,0 +1,161 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import requests
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient, ContainerClient
+from wav import mp3_to_wav
+from music_features import wav_to_features
+from workers import pool, PoolUnavailableError
+
+# retention policy for the intermediate artifacts, features and spectrogram are always persisted since predict consumes them
+#  persist: upload to the track's container, scratch: keep in the per-request scratch dir on disk only,
+#  tmpfs: keep in a memory-backed scratch dir only (/dev/shm), e.g. to hand the wav to openSMILE without touching disk
+retention_policies = ('persist', 'scratch', 'tmpfs')
+retention = {
+    'mp3': os.environ.get('RETAIN_MP3', 'scratch'),
+    'wav': os.environ.get('RETAIN_WAV', 'tmpfs')
+}
+for artifact, policy in retention.items():
+    if policy not in retention_policies:
+        raise ValueError('unknown retention policy %s for %s, expected one of %s' % (policy, artifact, retention_policies))
+tmpfs_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# pyplot keeps global figure state, so spectrograms are drawn one at a time per process
+spectrogram_lock = threading.Lock()
+
+def draw_spectrogram(mp3_path: str, output_path: str):
+    # librosa and matplotlib are only imported where spectrograms are drawn, with workers that is not the host
+    from spectrogram import make_spectrogram
+    with spectrogram_lock:
+        make_spectrogram(mp3_path, output_path)
+
+def get_container_client(blob_service_client: BlobServiceClient, track_id: str) -> ContainerClient:
+    # Create container with track ID as name
+    container_name = f'spotify-{track_id}'
+    container_client: ContainerClient = None
+    try:
+        # Create the container with the specified name
+        container_client = blob_service_client.create_container(container_name)
+    except ResourceExistsError:
+        container_client = blob_service_client.get_container_client(container=container_name)
+        logging.info("Container '%s' already exists" % container_name)
+    except Exception as e:
+        logging.error("Error occurred while creating container '%s' %s" % (container_name, e))
+    return container_client
+
+def preprocess_track(blob_service_client: BlobServiceClient, track_id: str, preview_url: str, overwrite: bool = False) -> dict:
+    # download the preview, compute every artifact and upload them to the track's container
+    # returns the upload status of each artifact, track_id is expected to be lower-cased
+    # overwrite replaces existing artifacts, e.g. when re-running for a new feature version
+    # Download MP3 file from preview URL
+    response = requests.get(preview_url)
+    if response.status_code != 200:
+        raise ValueError("Failed to fetch MP3 data. Status code %s" % response.status_code)
+    mp3_data = response.content
+
+    container_client = get_container_client(blob_service_client, track_id)
+
+    upload_status = {
+        'track_id': track_id, # LOWER-CASE(D)
+        'mp3': False,
+        'spectrogram': False,
+        'wav': False,
+        'features': False,
+        # mp3 and wav stay False unless their policy is persist
+        'retention': dict(retention)
+    }
+
+    # scratch space is unique per call so concurrent calls for the same track never share files
+    scratch_dir = tempfile.mkdtemp(prefix=f'{track_id}-')
+    memory_dir = None
+    if tmpfs_dir is not None and 'tmpfs' in retention.values():
+        memory_dir = tempfile.mkdtemp(prefix=f'{track_id}-', dir=tmpfs_dir)
+    artifact_dirs = {artifact: memory_dir if policy == 'tmpfs' and memory_dir else scratch_dir
+                     for artifact, policy in retention.items()}
+    try:
+        # 1) upload mp3
+        mp3_file_name = f'song-{track_id}.mp3'
+        if retention['mp3'] == 'persist':
+            try:
+                # Upload the mp3 data as a blob with the specified name
+                container_client.upload_blob(name=mp3_file_name, data=mp3_data, overwrite=overwrite)
+                logging.info("Blob '%s' uploaded successfully" % mp3_file_name)
+                upload_status['mp3'] = True
+            except ResourceNotFoundError as e:
+                logging.error("Container does not exist %s" % e)
+            except ResourceExistsError:
+                logging.info("mp3 resource already exists for track %s" % track_id)
+                upload_status['mp3'] = True
+            except Exception as e:
+                logging.warning("Error occurred while uploading mp3 blob: %s" % e)
+
+        # create temp mp3 file
+        mp3_path = os.path.join(artifact_dirs['mp3'], mp3_file_name)
+        with open(file=mp3_path, mode="wb") as new_file:
+            new_file.write(mp3_data)
+
+        # assume container does not exist is caught above, do not catch anymore
+        # 2) wav
+        try:
+            wav_file_name = f'wav-{track_id}.wav'
+            wav_path = os.path.join(artifact_dirs['wav'], wav_file_name)
+            pool.run(mp3_to_wav, mp3_path, wav_path)
+            if retention['wav'] == 'persist':
+                # stream the file instead of holding the whole uncompressed wav in memory
+                with open(wav_path, 'rb') as wav_file:
+                    container_client.upload_blob(name=wav_file_name, data=wav_file, overwrite=overwrite)
+                logging.info("Blob '%s' uploaded successfully" % wav_file_name)
+                upload_status['wav'] = True
+        except PoolUnavailableError:
+            raise
+        except ResourceExistsError:
+            logging.info("wav resource already exists for track %s" % track_id)
+            upload_status['wav'] = True
+        except Exception as e:
+            logging.warning('Error occurred while uploading wav blob: %s' % e)
+
+        # 3) music features
+        try:
+            features_file_name = f'features-{track_id}.csv'
+            features_path = os.path.join(scratch_dir, features_file_name)
+            pool.run(wav_to_features, wav_path, features_path, track_id)
+            with open(features_path, 'rb') as features_file:
+                features_bytes = features_file.read()
+            container_client.upload_blob(name=features_file_name, data=features_bytes, overwrite=overwrite)
+            logging.info("Blob '%s' uploaded successfully" % features_file_name)
+            upload_status['features'] = True
+        except PoolUnavailableError:
+            raise
+        except ResourceExistsError:
+            logging.info("features resource already exists for track %s" % track_id)
+            upload_status['features'] = True
+        except Exception as e:
+            logging.warning('Error occurred while uploading features csv: %s' % e)
+
+        # 4) spectrogram
+        try:
+            spectrogram_file_name = f'spectrogram-{track_id}.png'
+            spectrogram_path = os.path.join(scratch_dir, spectrogram_file_name)
+            pool.run(draw_spectrogram, mp3_path, spectrogram_path)
+            with open(spectrogram_path, 'rb') as spectrogram_file:
+                spectrogram_bytes = spectrogram_file.read()
+            container_client.upload_blob(name=spectrogram_file_name, data=spectrogram_bytes, overwrite=overwrite)
+            logging.info("Blob '%s' uploaded successfully" % spectrogram_file_name)
+            upload_status['spectrogram'] = True
+        except PoolUnavailableError:
+            raise
+        except ResourceExistsError:
+            logging.info("spectrogram resource already exists for track %s" % track_id)
+            upload_status['spectrogram'] = True
+        except Exception as e:
+            logging.warning("Error occurred while uploading spectrogram blob: %s" % e)
+
+        return upload_status
+    finally:
+        # always clear scratch files
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        if memory_dir is not None:
+            shutil.rmtree(memory_dir, ignore_errors=True)
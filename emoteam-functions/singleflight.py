@@ -0,0 +1,40 @@
+import threading
+
+class _Call:
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error: BaseException = None
+
+class SingleFlight:
+  # coalesces concurrent calls with the same key, so only the first caller runs fn
+  # and every other caller waits for and shares its result (or its exception)
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls: dict[str, _Call] = {}
+
+  def do(self, key: str, fn):
+    with self._lock:
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = _Call()
+        self._calls[key] = call
+
+    if not leader:
+      call.done.wait()
+      if call.error is not None:
+        raise call.error
+      return call.result
+
+    try:
+      call.result = fn()
+    except BaseException as e:
+      call.error = e
+      raise
+    finally:
+      # forget the key before waking followers, later calls start a fresh computation
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+    return call.result
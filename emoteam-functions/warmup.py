@@ -0,0 +1,77 @@
+import importlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# heavy modules in the order the routes end up importing them, used for the startup profile
+# the audio stack is only imported by whichever process draws spectrograms, the preprocessing workers if there are any
+HOST_MODULES = [
+  'numpy',
+  'pandas',
+  'scipy.interpolate',
+  'PIL.Image',
+  'azure.storage.blob',
+  'torch',
+  'pydub',
+  'arff',
+]
+AUDIO_MODULES = [
+  'matplotlib.pyplot',
+  'numba',
+  'librosa',
+  'librosa.display',
+]
+HEAVY_MODULES = HOST_MODULES + AUDIO_MODULES
+
+def profile_imports(modules=HEAVY_MODULES) -> dict[str, float]:
+  # import each module and record how long it took in seconds
+  # modules that are already imported report 0.0, so call this before anything else touches them
+  report = {}
+  for name in modules:
+    already_loaded = name in sys.modules
+    start = time.perf_counter()
+    try:
+      importlib.import_module(name)
+    except ImportError as e:
+      logging.warning('could not import %s while profiling: %s' % (name, e))
+      continue
+    report[name] = 0.0 if already_loaded else time.perf_counter() - start
+  return report
+
+def warm_audio_stack():
+  # run mp3_to_wav and make_spectrogram on a short synthetic mp3, so the decoders load, the JIT compiles
+  # (and writes to NUMBA_CACHE_DIR) and matplotlib builds its font cache before a real request needs them
+  # the caller serializes this with other spectrograms drawn in the same process, see pipeline.spectrogram_lock
+  import numpy as np
+  import matplotlib
+  matplotlib.use('Agg')
+  from pydub import AudioSegment
+  from spectrogram import make_spectrogram
+  from wav import mp3_to_wav
+
+  # spotify previews are 44.1 kHz mp3s, librosa.load resamples them to 22.05 kHz like a real track
+  sr = 44100
+  y = (0.5 * np.sin(2 * np.pi * 440 * np.arange(sr) / sr) * 32767).astype(np.int16)
+  scratch_dir = tempfile.mkdtemp(prefix='warmup-')
+  try:
+    mp3_path = os.path.join(scratch_dir, 'warmup.mp3')
+    AudioSegment(y.tobytes(), frame_rate=sr, sample_width=2, channels=1).export(mp3_path, format='mp3')
+    mp3_to_wav(mp3_path, os.path.join(scratch_dir, 'warmup.wav'))
+    make_spectrogram(mp3_path, os.path.join(scratch_dir, 'warmup.png'))
+  finally:
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+  # startup import-time profile, e.g. `python warmup.py` or `python warmup.py --warm` during the image build
+  report = profile_imports()
+  total = sum(report.values())
+  for name, seconds in sorted(report.items(), key=lambda item: item[1], reverse=True):
+    print('%-24s %8.3fs' % (name, seconds))
+  print('%-24s %8.3fs' % ('total', total))
+  if '--warm' in sys.argv:
+    start = time.perf_counter()
+    warm_audio_stack()
+    print('%-24s %8.3fs' % ('audio warmup', time.perf_counter() - start))
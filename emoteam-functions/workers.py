@@ -0,0 +1,133 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# PREPROCESS_WORKERS: number of worker processes for the audio stages, 0 runs them inline on the request thread
+# PREPROCESS_MAX_QUEUE: how many stages may wait for a free worker before new work is rejected
+# PREPROCESS_START_METHOD: multiprocessing start method, forkserver avoids forking the threaded functions host
+pool_size = int(os.environ.get('PREPROCESS_WORKERS', os.cpu_count() or 1))
+max_queue = int(os.environ.get('PREPROCESS_MAX_QUEUE', 4 * max(pool_size, 1)))
+start_method = os.environ.get('PREPROCESS_START_METHOD', 'forkserver')
+
+class PoolUnavailableError(Exception):
+  # the stage did not run because of the pool itself, not the track, callers should retry later
+  pass
+
+class PoolBusyError(PoolUnavailableError):
+  # raised when the preprocessing queue is full
+  pass
+
+class WorkerCrashedError(PoolUnavailableError):
+  # raised when a worker process died (e.g. OOM killed) while the stage was queued or running,
+  # the broken pool is replaced so the next call starts fresh workers
+  pass
+
+def _init_worker():
+  # keep workers warm, the first stage a worker runs should not pay for imports and JIT
+  import warmup
+  try:
+    warmup.warm_audio_stack()
+  except Exception as e:
+    logging.warning('could not warm preprocessing worker %s' % e)
+
+def _timed_call(fn, args):
+  # runs inside the worker, returns the elapsed time alongside the result for utilization stats
+  start = time.perf_counter()
+  result = fn(*args)
+  return result, time.perf_counter() - start
+
+class PreprocessPool:
+  def __init__(self, size: int, queue_limit: int, method: str):
+    self.size = size
+    self.queue_limit = queue_limit
+    self.method = method
+    self._executor: ProcessPoolExecutor = None
+    self._lock = threading.Lock()
+    self._started_at = time.monotonic()
+    self._pending = 0
+    self._completed = 0
+    self._failed = 0
+    self._rejected = 0
+    self._crashes = 0
+    self._busy_seconds = 0.0
+
+  def _get_executor(self) -> ProcessPoolExecutor:
+    if self._executor is None:
+      self._executor = ProcessPoolExecutor(
+        max_workers=self.size,
+        mp_context=multiprocessing.get_context(self.method),
+        initializer=_init_worker
+      )
+    return self._executor
+
+  def run(self, fn, *args):
+    # run fn(*args) on a worker process and wait for its result
+    # fn must be a picklable top-level function
+    with self._lock:
+      if self._pending >= max(self.size, 1) + self.queue_limit:
+        self._rejected += 1
+        raise PoolBusyError('preprocessing queue is full (%d pending)' % self._pending)
+      self._pending += 1
+      if self.size > 0:
+        executor = self._get_executor()
+
+    try:
+      if self.size > 0:
+        result, elapsed = executor.submit(_timed_call, fn, args).result()
+      else:
+        result, elapsed = _timed_call(fn, args)
+    except BrokenProcessPool as e:
+      with self._lock:
+        self._pending -= 1
+        self._failed += 1
+        # concurrent callers see the same broken executor, only the first one replaces it
+        if self._executor is executor:
+          self._crashes += 1
+          self._executor = None
+          executor.shutdown(wait=False, cancel_futures=True)
+      raise WorkerCrashedError('preprocessing worker died: %s' % e) from e
+    except Exception:
+      with self._lock:
+        self._pending -= 1
+        self._failed += 1
+      raise
+
+    with self._lock:
+      self._pending -= 1
+      self._completed += 1
+      self._busy_seconds += elapsed
+    return result
+
+  def stats(self) -> dict:
+    with self._lock:
+      uptime = time.monotonic() - self._started_at
+      workers = max(self.size, 1)
+      return {
+        'workers': self.size,
+        'start_method': self.method,
+        'max_queue': self.queue_limit,
+        'running': min(self._pending, workers),
+        'queued': max(self._pending - workers, 0),
+        'completed': self._completed,
+        'failed': self._failed,
+        'crashes': self._crashes,
+        'rejected': self._rejected,
+        'busy_seconds': self._busy_seconds,
+        'utilization': self._busy_seconds / (workers * uptime) if uptime > 0 else 0.0
+      }
+
+  def warm(self):
+    # start every worker process now instead of on the first request
+    if self.size <= 0:
+      return
+    with self._lock:
+      executor = self._get_executor()
+    futures = [executor.submit(time.sleep, 0) for _ in range(self.size)]
+    for future in futures:
+      future.result()
+
+pool = PreprocessPool(pool_size, max_queue, start_method)